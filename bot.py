@@ -1,16 +1,20 @@
 
+import asyncio
 import os
 import html
 import logging
 import re
-from datetime import datetime
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime
 from datetime import timedelta
 from zoneinfo import ZoneInfo
+from operator import itemgetter
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from dotenv import load_dotenv
 from openpyxl import load_workbook
+from openpyxl.utils.datetime import from_excel as _from_excel
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import (
@@ -21,12 +25,23 @@ from telegram.ext import (
     filters,
 )
 
+# Rust-backed reader; openpyxl is kept as a fallback when it is not installed
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
 DATA_DIR = Path('data')
 DATA_DIR.mkdir(exist_ok=True)
+# Uploads land here first and are moved into DATA_DIR once they parse
+UPLOAD_DIR = DATA_DIR / 'incoming'
+UPLOAD_DIR.mkdir(exist_ok=True)
 
 load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN') or ''
 TEST_MODE = (os.getenv('TEST_MODE') or '').strip() in {'1', 'true', 'True', 'yes', 'on'}
+# Telegram user ids allowed to use /update (comma-separated)
+ADMIN_IDS = frozenset(int(x) for x in (os.getenv('ADMIN_IDS') or '669636800').split(',') if x.strip())
 
 # Determine local timezone (fallback to system local if available)
 try:
@@ -51,77 +66,189 @@ SHEET_ALIASES = {
     ASSIGNMENTS_SHEET: {ASSIGNMENTS_SHEET, 'Assignments', 'Задания', 'Дедлайны'},
     INFO_SHEET: {INFO_SHEET, 'Info', 'Информация'},
 }
+# Lower-cased aliases so sheet names match regardless of case
+SHEET_ALIASES_CI = {canonical: {a.lower() for a in names} for canonical, names in SHEET_ALIASES.items()}
+
+_AT_RE = re.compile(r"^@+")
+_SCHEME_RE = re.compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*://")
 
 CourseWeights = Dict[str, float]
-Assignment = Tuple[str, datetime, str]
+# (title, due date, link, due date formatted as dd.mm.yyyy, rendered HTML bullet line,
+#  due datetime — keeps the cell's time of day, midnight for date-only values)
+Assignment = Tuple[str, date, str, str, str, datetime]
+InfoItem = Tuple[str, str]
+# Each part is None when its sheet is missing from the workbook
+ParsedWorkbook = Tuple[Optional[CourseWeights], Optional[List[Assignment]], Optional[List[InfoItem]]]
+
+_due_key = itemgetter(1)
+_due_at_key = itemgetter(5)
+
+
+def _open(xlsx_path: Path):
+    if CalamineWorkbook is not None:
+        return CalamineWorkbook.from_path(str(xlsx_path))
+    # read_only streams sheet XML instead of building the full object model
+    return load_workbook(xlsx_path, data_only=True, read_only=True, keep_links=False)
+
+
+def _sheet_names(wb) -> List[str]:
+    if CalamineWorkbook is not None:
+        return wb.sheet_names
+    return wb.sheetnames
+
+
+def _iter_rows(wb, name: str, width: int) -> Iterator[tuple]:
+    # Data rows (header skipped), padded to `width` columns
+    if CalamineWorkbook is None:
+        yield from wb[name].iter_rows(min_row=2, max_col=width, values_only=True)
+        return
+    # Normalise to openpyxl's values: calamine returns whole numbers as float
+    # and empty cells as ''
+    rows = wb.get_sheet_by_name(name).to_python(skip_empty_area=False)
+    for row in rows[1:]:
+        values = [
+            None if v == '' else int(v) if type(v) is float and v.is_integer() else v
+            for v in row[:width]
+        ]
+        if len(values) < width:
+            values += [None] * (width - len(values))
+        yield tuple(values)
 
 
 def find_sheet_name(wb, canonical: str) -> Optional[str]:
-    aliases = SHEET_ALIASES[canonical]
-    for name in wb.sheetnames:
-        if name in aliases:
-            return name
-    return None
+    aliases = SHEET_ALIASES_CI[canonical]
+    return next((name for name in _sheet_names(wb) if name.lower() in aliases), None)
 
 
-def parse_weights(xlsx_path: Path) -> CourseWeights:
-    wb = load_workbook(xlsx_path, data_only=True)
-    name = find_sheet_name(wb, ASSESSMENT_SHEET)
-    if not name:
-        raise ValueError('Sheet with course weights not found')
-    ws = wb[name]
+def _read_weights(rows: Iterable[tuple]) -> CourseWeights:
+    _str, _isinstance, _float = str, isinstance, float
     weights: CourseWeights = {}
     # Expect two columns: label and weight (like in screenshot)
-    for row in ws.iter_rows(min_row=2, values_only=True):
+    for row in rows:
         if not row or (row[0] is None and row[1] is None):
             continue
-        label = str(row[0]).strip() if row[0] is not None else ''
+        label = _str(row[0]).strip() if row[0] is not None else ''
         val = row[1]
-        if label and isinstance(val, (int, float)):
-            weights[label] = float(val)
+        if label and _isinstance(val, (int, float)):
+            weights[label] = _float(val)
     return weights
 
 
-def parse_assignments(xlsx_path: Path) -> List[Assignment]:
-    wb = load_workbook(xlsx_path, data_only=True)
-    name = find_sheet_name(wb, ASSIGNMENTS_SHEET)
-    if not name:
-        raise ValueError('Sheet with assignments not found')
-    ws = wb[name]
+def _format_assignment_line(title: str, link: str, date_str: str) -> str:
+    safe_title = html.escape(title)
+    if link:
+        safe_link = html.escape(link)
+        return f"• <a href=\"{safe_link}\">{safe_title}</a> — {date_str}"
+    return f"• {safe_title} — {date_str}"
+
+
+def _read_assignments(rows: Iterable[tuple]) -> List[Assignment]:
+    _str, _isinstance, _int, _dt, _date = str, isinstance, int, datetime, date
+    _number = (int, float)
     results: List[Assignment] = []
+    append = results.append
     # Expect columns: Title, Due date, Link
-    for row in ws.iter_rows(min_row=2, values_only=True):
+    for row in rows:
         if not row or (row[0] is None and row[1] is None and row[2] is None):
             continue
-        title = (str(row[0]).strip()) if row[0] is not None else ''
+        title = (_str(row[0]).strip()) if row[0] is not None else ''
         due_raw = row[1]
-        link = (str(row[2]).strip()) if row[2] is not None else ''
+        link = (_str(row[2]).strip()) if row[2] is not None else ''
         if not title:
             continue
-        # Convert date: accept datetime or dd.mm.yyyy string
-        if isinstance(due_raw, datetime):
-            due = due_raw
-        elif isinstance(due_raw, (int, float)):
+        # Convert date: accept datetime/date or dd.mm.yyyy string
+        if _isinstance(due_raw, _dt):
+            due_at = due_raw
+        elif _isinstance(due_raw, _date):
+            due_at = _dt(due_raw.year, due_raw.month, due_raw.day)
+        elif _isinstance(due_raw, _number):
             # Excel serial date, attempt conversion
             try:
-                from openpyxl.utils.datetime import from_excel
-                due = from_excel(due_raw)
+                due_at = _from_excel(due_raw)
             except Exception:
                 continue
-        elif isinstance(due_raw, str):
-            m = re.match(r"(\d{2})\.(\d{2})\.(\d{4})", due_raw.strip())
-            if not m:
+            # serials below 1 come back as times, not dates
+            if not _isinstance(due_at, _dt):
+                continue
+        elif _isinstance(due_raw, _str):
+            # dd.mm.yyyy (anything after the year is ignored)
+            d = due_raw.strip()
+            if not (len(d) >= 10 and d[2] == '.' and d[5] == '.'
+                    and d[0:2].isdecimal() and d[3:5].isdecimal() and d[6:10].isdecimal()):
+                continue
+            try:
+                due_at = _dt(_int(d[6:10]), _int(d[3:5]), _int(d[0:2]))
+            except ValueError:
                 continue
-            day, month, year = map(int, m.groups())
-            due = datetime(year, month, day)
         else:
             continue
-        results.append((title, due, link))
-    # sort by date
-    results.sort(key=lambda x: x[1])
+        due = due_at.date()
+        date_str = due.strftime('%d.%m.%Y')
+        append((title, due, link, date_str, _format_assignment_line(title, link, date_str), due_at))
+    # sort by due datetime (this also orders by date)
+    results.sort(key=_due_at_key)
     return results
 
 
+def _read_info(rows: Iterable[tuple]) -> List[InfoItem]:
+    _str = str
+    items: List[InfoItem] = []
+    for row in rows:
+        if not row or (row[0] is None and row[1] is None):
+            continue
+        key = _str(row[0]).strip() if row[0] is not None else ''
+        val = _str(row[1]).strip() if row[1] is not None else ''
+        if key:
+            items.append((key, val))
+    return items
+
+
+def parse_all(xlsx_path: Path) -> ParsedWorkbook:
+    # Single workbook open for all three sheets; a missing sheet yields None so
+    # each command only requires the sheets it actually uses
+    wb = _open(xlsx_path)
+    try:
+        weights_name = find_sheet_name(wb, ASSESSMENT_SHEET)
+        assignments_name = find_sheet_name(wb, ASSIGNMENTS_SHEET)
+        info_name = find_sheet_name(wb, INFO_SHEET)
+        weights = _read_weights(_iter_rows(wb, weights_name, 2)) if weights_name else None
+        assignments = _read_assignments(_iter_rows(wb, assignments_name, 3)) if assignments_name else None
+        info = _read_info(_iter_rows(wb, info_name, 2)) if info_name else None
+    finally:
+        wb.close()
+    return weights, assignments, info
+
+
+def _require_summary_sheets(parsed: ParsedWorkbook) -> None:
+    # /help and upload validation need both the weights and the assignments
+    weights, assignments, _ = parsed
+    if weights is None:
+        raise ValueError('Sheet with course weights not found')
+    if assignments is None:
+        raise ValueError('Sheet with assignments not found')
+
+
+# Parsed workbooks keyed by path; an entry is replaced once the file's mtime changes.
+# Handlers parse in worker threads, so two may race on a miss; the later write just wins.
+_PARSE_CACHE: Dict[str, Tuple[int, ParsedWorkbook]] = {}
+
+
+def _cached_parse(xlsx_path: Path) -> ParsedWorkbook:
+    key = str(xlsx_path)
+    mtime = os.stat(xlsx_path).st_mtime_ns
+    cached = _PARSE_CACHE.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    parsed = parse_all(xlsx_path)
+    _PARSE_CACHE[key] = (mtime, parsed)
+    return parsed
+
+
+def _store_parsed(xlsx_path: Path, parsed: ParsedWorkbook) -> None:
+    # Prime the cache with an already parsed file (e.g. right after an upload)
+    _PARSE_CACHE[str(xlsx_path)] = (os.stat(xlsx_path).st_mtime_ns, parsed)
+
+
 def format_formula(weights: CourseWeights) -> str:
     if not weights:
         return 'Формула пока не задана. Загрузите Excel с листом "Оценивание".'
@@ -134,63 +261,47 @@ def format_nearest(assignments: List[Assignment], limit: int = 5) -> str:
         return 'Нет данных о дедлайнах. Загрузите Excel с листом "Задания".'
     now = datetime.now()
     horizon = now + timedelta(days=14)
-    window = [a for a in assignments if now <= a[1] <= horizon]
-    lines = []
-    for title, due, link in window[:limit]:
-        date_str = due.strftime('%d.%m.%Y')
-        safe_title = html.escape(title)
-        if link:
-            safe_link = html.escape(link)
-            lines.append(f"• <a href=\"{safe_link}\">{safe_title}</a> — {date_str}")
-        else:
-            lines.append(f"• {safe_title} — {date_str}")
-    if not lines:
+    # assignments are sorted by due datetime, so the window [now, horizon] can be bisected
+    lo = bisect_left(assignments, now, key=_due_at_key)
+    hi = min(bisect_right(assignments, horizon, lo=lo, key=_due_at_key), lo + limit)
+    if lo == hi:
         return 'В ближайшие 2 недели дедлайнов нет.'
-    return "\n".join(lines)
+    return "\n".join([a[4] for a in assignments[lo:hi]])
 
 
-def get_chat_file(chat_id: str) -> Path:
-    return DATA_DIR / f"{chat_id}.xlsx"
+def _due_on(assignments: List[Assignment], day: date) -> List[Assignment]:
+    lo = bisect_left(assignments, day, key=_due_key)
+    hi = bisect_right(assignments, day, lo=lo, key=_due_key)
+    return assignments[lo:hi]
 
 
-def parse_info(xlsx_path: Path) -> List[Tuple[str, str]]:
-    wb = load_workbook(xlsx_path, data_only=True)
-    name = find_sheet_name(wb, INFO_SHEET)
-    if not name:
-        raise ValueError('Лист с информацией ("Инфо") не найден')
-    ws = wb[name]
-    rows: List[Tuple[str, str]] = []
-    for row in ws.iter_rows(min_row=2, values_only=True):
-        if not row or (row[0] is None and row[1] is None):
-            continue
-        key = str(row[0]).strip() if row[0] is not None else ''
-        val = str(row[1]).strip() if row[1] is not None else ''
-        if key:
-            rows.append((key, val))
-    return rows
+def get_chat_file(chat_id: str) -> Path:
+    return DATA_DIR / f"{chat_id}.xlsx"
 
 
-def format_info(items: List[Tuple[str, str]]) -> str:
+def format_info(items: List[InfoItem]) -> str:
     if not items:
         return 'Нет данных на листе "Инфо".'
     username_keys = {'Преподаватель', 'Ассистент', 'Канал'}
+    _escape = html.escape
     lines: List[str] = ['Привет! Ниже приведены ссылки на основные ресурсы курса 👇']
+    append = lines.append
     for key, val in items:
-        safe_key = html.escape(key)
+        safe_key = _escape(key)
         if key in username_keys:
-            uname = re.sub(r"^@+", '', val).strip()
+            uname = _AT_RE.sub('', val).strip()
             if uname:
                 display = '@' + uname
             else:
                 display = ''
-            lines.append(f"• <b>{safe_key}</b>: {html.escape(display)}")
+            append(f"• <b>{safe_key}</b>: {_escape(display)}")
         else:
             link = val.strip()
             # Basic normalization: add scheme if missing for tg client to open
-            if link and not re.match(r"^[a-zA-Z][a-zA-Z0-9+.-]*://", link):
+            if link and not _SCHEME_RE.match(link):
                 link = 'https://' + link
-            safe_link = html.escape(link)
-            lines.append(f"• <a href=\"{safe_link}\">{safe_key}</a>")
+            safe_link = _escape(link)
+            append(f"• <a href=\"{safe_link}\">{safe_key}</a>")
     return "\n\n".join(lines)
 
 
@@ -201,36 +312,25 @@ async def daily_reminder_callback(context: ContextTypes.DEFAULT_TYPE) -> None:
     if not chat_id or not xlsx_path:
         return
     try:
-        assignments = parse_assignments(Path(xlsx_path))
+        _, assignments, _ = await asyncio.to_thread(_cached_parse, Path(xlsx_path))
     except Exception:
         return
+    if assignments is None:
+        return
 
     now = datetime.now(tz=LOCAL_TZ) if LOCAL_TZ else datetime.now()
     today = now.date()
     week_target = today + timedelta(days=7)
     day_target = today + timedelta(days=1)
 
-    week_items: List[Assignment] = []
-    day_items: List[Assignment] = []
-    for title, due, link in assignments:
-        due_date = (due.astimezone(LOCAL_TZ).date() if (LOCAL_TZ and due.tzinfo) else due.date())
-        if due_date == week_target:
-            week_items.append((title, due, link))
-        if due_date == day_target:
-            day_items.append((title, due, link))
+    week_items = _due_on(assignments, week_target)
+    day_items = _due_on(assignments, day_target)
 
     def build_message(label: str, items: List[Assignment]) -> Optional[str]:
         if not items:
             return None
         lines: List[str] = [f"🔔 Напоминание <b>{label}</b> до дедлайна:"]
-        for title, due, link in items:
-            date_str = due.strftime('%d.%m.%Y')
-            safe_title = html.escape(title)
-            if link:
-                safe_link = html.escape(link)
-                lines.append(f"• <a href=\"{safe_link}\">{safe_title}</a> — {date_str}")
-            else:
-                lines.append(f"• {safe_title} — {date_str}")
+        lines.extend([a[4] for a in items])
         return "\n".join(lines)
 
     week_text = build_message('за неделю', week_items)
@@ -246,8 +346,9 @@ def schedule_chat_reminders(chat_id: int, xlsx_path: Path, context: ContextTypes
     jq = context.job_queue
     if jq is None:
         return
-    # Remove previous jobs for this chat
-    jq.scheduler.remove_all_jobs()
+    # Remove previous jobs for this chat only
+    for old_job in jq.get_jobs_by_name(f"daily:{chat_id}"):
+        old_job.schedule_removal()
 
     if TEST_MODE:
         # Run every 15 seconds for quick verification
@@ -282,14 +383,15 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
     try:
-        weights = parse_weights(xlsx_path)
-        assignments = parse_assignments(xlsx_path)
+        parsed = await asyncio.to_thread(_cached_parse, xlsx_path)
+        _require_summary_sheets(parsed)
     except Exception as exc:
         await update.message.reply_text(
             'Не удалось прочитать файл. Загрузите корректный Excel. '
             f'Ошибка: {exc}'
         )
         return
+    weights, assignments, _ = parsed
 
     formula = format_formula(weights)
     deadlines = format_nearest(assignments)
@@ -313,7 +415,9 @@ async def info_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
     try:
-        items = parse_info(xlsx_path)
+        _, _, items = await asyncio.to_thread(_cached_parse, xlsx_path)
+        if items is None:
+            raise ValueError('Лист с информацией ("Инфо") не найден')
     except Exception as exc:
         await update.message.reply_text(
             'Не удалось прочитать лист "Инфо". Загрузите корректный Excel. '
@@ -328,7 +432,7 @@ async def update_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     user_id = update.message.from_user.id
     
     # Check if this is the authorized user
-    if user_id != 669636800:
+    if user_id not in ADMIN_IDS:
         await update.message.reply_text(
             'У вас нет прав для использования этой команды. '
             'Доступ ограничен для администратора бота.'
@@ -380,19 +484,33 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     name = f'{update.message.chat.title}_{chat_id}'
 
     new_path = get_chat_file(name)
+    # One temp file per upload (updates run concurrently); keep the .xlsx
+    # suffix (openpyxl checks it) and only replace the current file once it parses
+    tmp_path = UPLOAD_DIR / f'{new_path.stem}.{message.message_id}.xlsx'
     tg_file = await doc.get_file()
-    await tg_file.download_to_drive(str(new_path))
 
-    # Validate content
+    # Download and validate content; a failed or partial download is removed too
     try:
-        _ = parse_weights(new_path)
-        _ = parse_assignments(new_path)
+        await tg_file.download_to_drive(tmp_path)
+        parsed = await asyncio.to_thread(parse_all, tmp_path)
+        _require_summary_sheets(parsed)
     except Exception as exc:
+        tmp_path.unlink(missing_ok=True)
+        await update.message.reply_text(
+            'Не удалось загрузить или прочитать файл, он не сохранён (предыдущая версия не изменена). '
+            f'Проверьте файл и структуру листов. Ошибка: {exc}'
+        )
+        return
+    try:
+        tmp_path.replace(new_path)
+    except OSError as exc:
+        tmp_path.unlink(missing_ok=True)
         await update.message.reply_text(
-            'Файл сохранён, но не удалось его прочитать полностью. '
-            f'Проверьте структуру листов. Ошибка: {exc}'
+            'Не удалось сохранить файл (предыдущая версия не изменена). '
+            f'Попробуйте отправить его ещё раз. Ошибка: {exc}'
         )
         return
+    _store_parsed(new_path, parsed)
 
     if is_update_request:
         try:
@@ -426,7 +544,8 @@ def main() -> None:
                 continue
             schedule_chat_reminders(chat_id, path, application)
 
-    app = Application.builder().token(token).post_init(startup).build()
+    # Handle updates concurrently so a slow upload in one chat doesn't stall the others
+    app = Application.builder().token(token).concurrent_updates(32).post_init(startup).build()
 
     app.add_handler(CommandHandler('help', help_cmd))
     app.add_handler(CommandHandler('info', info_cmd))